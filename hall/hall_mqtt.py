@@ -1,78 +1,108 @@
 import paho.mqtt.client as mqtt
-from gpiozero import Button
+from gpiozero import Button, Device
+from gpiozero.pins.pigpio import PiGPIOFactory
+import pigpio
+from functools import partial
 from signal import pause
-import time
+import logging
+import logging.handlers
+import queue
+import socket
 
 # --- Konfiguration ---
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
 
-# Sensor 1 (Schiene 1)
-SENSOR_PIN_1 = 17 # GPIO 17
-MQTT_TOPIC_1 = "sensor/schiene_1" # Eindeutiges Topic für Sensor 1
-
-# Sensor 2 (Schiene 2) - NEU
-SENSOR_PIN_2 = 27 # GPIO 27
-MQTT_TOPIC_2 = "sensor/schiene_2" # Eindeutiges Topic für Sensor 2
+# (GPIO-Pin, Topic) je Schiene, Schiene 1 zuerst
+SENSORS = [
+    (17, "sensor/schiene_1"), # GPIO 17
+    (27, "sensor/schiene_2"), # GPIO 27
+]
+
+# Entprellung: Flanken innerhalb dieses Fensters zählen als ein Ereignis.
+# Bewusst nicht als bounce_time am Button: unter pigpio wird daraus ein
+# Glitch-Filter, der die nur wenige ms langen Magnetimpulse verschlucken würde.
+BOUNCE_US = 50_000 # Mikrosekunden
+TICK_WRAP = 1 << 32 # pigpio-Ticks sind ein 32-Bit-µs-Zähler
 # --- Ende Konfiguration ---
 
-# Initialisiere beide Sensoren
-hall_sensor_1 = Button(SENSOR_PIN_1, pull_up=True)
-hall_sensor_2 = Button(SENSOR_PIN_2, pull_up=True) # NEU
+# Logging über eine Queue: die GPIO-Callbacks blockieren nie auf stdout,
+# geschrieben wird im Hintergrund-Thread des QueueListeners
+_log_queue = queue.Queue()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s",
+                    handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+log = logging.getLogger("carrera.hall")
+
+# pigpio-Backend (benötigt laufenden pigpiod) für µs-genaue Zeitstempel
+Device.pin_factory = PiGPIOFactory()
 
 # --- MQTT-Setup ---
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
-        print("Erfolgreich mit MQTT-Broker verbunden.")
+        log.info("Erfolgreich mit MQTT-Broker verbunden.")
     else:
-        print(f"Verbindung fehlgeschlagen mit Code: {rc}")
+        log.error("Verbindung fehlgeschlagen mit Code: %s", rc)
 
-client = mqtt.Client()
+def on_socket_open(client, userdata, sock):
+    # Nagle abschalten, damit kurz aufeinanderfolgende Ereignisse nicht ~40ms warten
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+client = mqtt.Client(clean_session=True)
 client.on_connect = on_connect
+client.on_socket_open = on_socket_open
 
 try:
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
 except ConnectionRefusedError:
-    print("Verbindung zum MQTT-Broker fehlgeschlagen. Läuft der Mosquitto-Dienst?")
+    log.critical("Verbindung zum MQTT-Broker fehlgeschlagen. Läuft der Mosquitto-Dienst?")
+    _log_listener.stop() # Ausstehende Meldungen noch ausgeben
     exit()
 
 client.loop_start()
 
-# --- Callback-Funktionen für Sensor 1 ---
-def magnet_1_erkannt():
-    print("Schiene 1: Magnet erkannt! Sende MQTT...")
-    client.publish(MQTT_TOPIC_1, "MAGNET_ERKANNT")
-
-def magnet_1_entfernt():
-    print("Schiene 1: Kein Magnet. (log)")
-    #client.publish(MQTT_TOPIC_1, "KEIN_MAGNET")
+publish = client.publish
+pi = Device.pin_factory.connection # pigpio-Verbindung der gpiozero-Factory
 
-# --- Callback-Funktionen für Sensor 2 (NEU) ---
-def magnet_2_erkannt():
-    print("Schiene 2: Magnet erkannt! Sende MQTT...")
-    client.publish(MQTT_TOPIC_2, "MAGNET_ERKANNT") # Sendet auf Topic 2
+# Tick des letzten gesendeten Ereignisses je Schiene (Software-Entprellung)
+_last = [None] * len(SENSORS)
 
-def magnet_2_entfernt():
-    print("Schiene 2: Kein Magnet. (log)")
-    #client.publish(MQTT_TOPIC_2, "KEIN_MAGNET") # Sendet auf Topic 2
+# --- Gemeinsame Callback-Funktionen für alle Sensoren ---
+def magnet_erkannt(index, topic, gpio, level, tick):
+    # tick ist der von pigpio beim Flankenwechsel erfasste µs-Zeitstempel
+    last = _last[index]
+    if last is not None and (tick - last) % TICK_WRAP < BOUNCE_US:
+        return
+    _last[index] = tick
+    log.debug("Schiene %d: Magnet erkannt! Sende MQTT...", index + 1)
+    # QoS 0 ohne Retain: Latenz ist wichtiger als Zustellgarantie
+    publish(topic, str(tick), qos=0, retain=False)
 
+def magnet_entfernt(index):
+    log.debug("Schiene %d: Kein Magnet. (log)", index + 1)
 
-# --- Sensor-Ereignisse zuweisen ---
-# Sensor 1
-hall_sensor_1.when_pressed = magnet_1_erkannt
-hall_sensor_1.when_released = magnet_1_entfernt
 
-# Sensor 2 (NEU)
-hall_sensor_2.when_pressed = magnet_2_erkannt
-hall_sensor_2.when_released = magnet_2_entfernt
+# --- Sensoren initialisieren und Ereignisse zuweisen ---
+buttons = [] # Referenzen halten, genau ein Button pro Pin
+callbacks = []
+for index, (pin, topic) in enumerate(SENSORS):
+    # Der Button konfiguriert den Pull-up; Magnet erkannt = fallende Flanke
+    button = Button(pin, pull_up=True)
+    button.when_released = partial(magnet_entfernt, index)
+    buttons.append(button)
+    callbacks.append(pi.callback(pin, pigpio.FALLING_EDGE, partial(magnet_erkannt, index, topic)))
+    log.info("Überwachung für Schiene %d (GPIO %d) gestartet.", index + 1, pin)
 
-print(f"Überwachung für Schiene 1 (GPIO {SENSOR_PIN_1}) und Schiene 2 (GPIO {SENSOR_PIN_2}) gestartet.")
-print("Warte auf Magnete...")
+log.info("Warte auf Magnete...")
 
 # Das Skript am Laufen halten
 try:
     pause()
 except KeyboardInterrupt:
-    print("Skript beendet.")
+    log.info("Skript beendet.")
+    for cb in callbacks:
+        cb.cancel()
     client.loop_stop()
-    client.disconnect()
\ No newline at end of file
+    client.disconnect()
+    _log_listener.stop()
\ No newline at end of file
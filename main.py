@@ -1,86 +1,270 @@
 import uvicorn
 import asyncio
+import logging
 import time
 import random
+import socket
+import zlib
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse
 import aiomqtt
+import orjson
+from array import array
 from contextlib import asynccontextmanager
-from typing import List, Union
+from dataclasses import dataclass, field
+from typing import List, Set, Union
 
 # --- CONFIGURATION ---
-BROKER_ADDRESS = "192.168.1.144"
+BROKER_ADDRESS = "localhost" # Run Mosquitto on this host to skip a network hop
+MQTT_KEEPALIVE = 30 # Seconds, detects a dead broker connection sooner
 TOPIC_RACE_START = "carrera/race/start"
-TOPIC_TRACK1_FINISH = "sensor/schiene_1"
-TOPIC_TRACK2_FINISH = "sensor/schiene_2"
+# Finish-line topics are TOPIC_TRACK_PREFIX + track number, e.g. "sensor/schiene_1".
+# MQTT wildcards must span a whole level, so subscribe to "sensor/+" and filter.
+TOPIC_TRACK_PREFIX = "sensor/schiene_"
+TOPIC_TRACK_FILTER = "sensor/+"
+TICK_WRAP = 1 << 32 # Sensor ticks are pigpio's 32-bit microsecond counter
+OUT_QUEUE_SIZE = 64 # Max pending messages per WebSocket client
+BROADCAST_QUEUE_SIZE = 1024 # Max messages waiting for the broadcaster task
+BATCH_WINDOW = 0.005 # Seconds to wait for more messages to coalesce into one frame
+COMPRESS_MIN_SIZE = 1024 # Payloads at least this big are zlib-compressed once for all clients
 # --- END CONFIGURATION ---
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+# Per-event messages are DEBUG, so they cost nothing unless enabled
+log = logging.getLogger("carrera")
+
+monotonic = time.monotonic # Pre-bound for the MQTT hot path
+
+def dump_json(data: dict) -> bytes:
+    """Serializes a message to compact UTF-8 JSON bytes.
+    Large payloads are zlib-compressed; the 0x78 header byte can't start JSON,
+    so the frontend can tell the two apart.
+    """
+    payload = orjson.dumps(data)
+    if len(payload) >= COMPRESS_MIN_SIZE:
+        return zlib.compress(payload, 1)
+    return payload
+
+def is_compressed(payload: bytes) -> bool:
+    """True if dump_json compressed this payload."""
+    return payload[0] == 0x78
+
 # --- Global MQTT Client & Tasks ---
 # These will be initialized during the 'lifespan' startup event
 mqtt_client: Union[aiomqtt.Client, None] = None
 mqtt_listener_task: Union[asyncio.Task, None] = None
+broadcaster_task: Union[asyncio.Task, None] = None
 # --- Global Race State ---
-race_data = {
-    "status": "idle", # "idle", "running", "finished"
-    "tracks": {
-        1: {"lap_start_time": 0.0, "laps": []},
-        2: {"lap_start_time": 0.0, "laps": []}
-    }
-}
+@dataclass(slots=True)
+class TrackState:
+    """Timing state for a single track."""
+    lap_start_time: float = 0.0
+    laps: array = field(default_factory=lambda: array("d")) # Unboxed float64 lap times
+    last_tick: Union[int, None] = None # Sensor tick of the previous crossing
+    fastest: float = 0.0 # Best lap so far, kept up to date by record_lap
+
+@dataclass(slots=True)
+class RaceState:
+    """Race status plus one TrackState per track, indexed by track - 1."""
+    status: str = "idle" # "idle", "running", "finished"
+    tracks: tuple = field(default_factory=lambda: (TrackState(), TrackState()))
+
+race = RaceState()
+# Serialized full_state message, rebuilt lazily after any write to it
+_state_cache: Union[bytes, None] = None
+
+def invalidate_state():
+    """Drops the cached full_state payload after the race state changed."""
+    global _state_cache
+    _state_cache = None
+
+def set_status(status: str):
+    """Sets the race status and invalidates the cached full state."""
+    race.status = status
+    invalidate_state()
+
+def record_lap(t: TrackState, lap_time_sec: float):
+    """Appends a finished lap and invalidates the cached full state."""
+    t.laps.append(lap_time_sec)
+    if t.fastest == 0.0 or lap_time_sec < t.fastest:
+        t.fastest = lap_time_sec
+    invalidate_state()
 
 def reset_race_state():
     """Helper function to reset the global race state."""
-    global race_data
-    race_data["status"] = "idle"
-    race_data["tracks"][1]["lap_start_time"] = 0.0
-    race_data["tracks"][1]["laps"] = []
-    race_data["tracks"][2]["lap_start_time"] = 0.0
-    race_data["tracks"][2]["laps"] = []
-    print("Race state has been reset.")
+    for t in race.tracks:
+        t.lap_start_time = 0.0
+        t.laps = array("d")
+        t.last_tick = None
+        t.fastest = 0.0
+    set_status("idle")
+    log.info("Race state has been reset.")
+
+def parse_tick(payload) -> Union[int, None]:
+    """Extracts the sensor tick from a '<tick>' or 'MAGNET_ERKANNT <tick>' payload, if present."""
+    if not isinstance(payload, (bytes, bytearray)):
+        return None
+    parts = payload.split()
+    if not parts:
+        return None
+    try:
+        return int(parts[-1])
+    except ValueError:
+        return None
 
 # NEW: Helper to get the current state for new clients
 def get_current_state_message():
     """Creates a message object representing the full current state."""
-    laps_1 = race_data["tracks"][1]["laps"]
-    laps_2 = race_data["tracks"][2]["laps"]
+    laps_1 = race.tracks[0].laps
+    laps_2 = race.tracks[1].laps
     
     return {
         "type": "full_state", # Frontend will need to handle this
-        "status": race_data["status"],
-        "track_1_laps": laps_1,
-        "track_2_laps": laps_2,
+        "status": race.status,
+        "track_1_laps": laps_1.tolist(), # orjson can't encode array.array
+        "track_2_laps": laps_2.tolist(),
         "track_1_last_lap": laps_1[-1] if laps_1 else 0,
         "track_2_last_lap": laps_2[-1] if laps_2 else 0,
     }
 
+def get_state_payload() -> bytes:
+    """Returns the serialized full_state message, building it only when stale."""
+    global _state_cache
+    if _state_cache is None:
+        _state_cache = dump_json(get_current_state_message())
+    return _state_cache
+
+def _splice(payloads: List[bytes]) -> bytes:
+    """Wraps already-encoded JSON events in a batch frame without re-serializing."""
+    return b'{"type":"batch","events":[' + b",".join(payloads) + b"]}"
+
+# NEW: Per-client connection wrapper
+class Connection:
+    """A connected client with its own outbound queue and writer task."""
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        # Bounded so a stalled client can't grow memory without limit
+        self.out_queue: asyncio.Queue = asyncio.Queue(maxsize=OUT_QUEUE_SIZE)
+        self.writer_task: Union[asyncio.Task, None] = None
+        self.closed = False # Set on disconnect, even before registration
+
+    def enqueue(self, payload: bytes):
+        """Queue a serialized message without blocking, dropping the oldest one if full."""
+        try:
+            self.out_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.out_queue.get_nowait()
+            self.out_queue.put_nowait(payload)
+
 # NEW: Connection Manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[Connection] = set()
+        # Decouples producers (e.g. the MQTT loop) from encoding and fan-out.
+        # Holds message dicts and new Connections, handled strictly in order.
+        self.broadcast_q: asyncio.Queue = asyncio.Queue(maxsize=BROADCAST_QUEUE_SIZE)
 
-    async def connect(self, websocket: WebSocket):
-        """Accept a new client and send them the current race state."""
+    async def connect(self, websocket: WebSocket) -> Connection:
+        """Accept a new client and hand it to the broadcaster for registration."""
+        conn = Connection(websocket)
         await websocket.accept()
-        self.active_connections.append(websocket)
-        # Send the current state so the new client can catch up
-        await websocket.send_json(get_current_state_message())
+        # Snapshot the state and queue the registration with no await in
+        # between: changes before this point are in full_state, and every
+        # broadcast queued after it reaches the client exactly once
+        while self.broadcast_q.full():
+            await asyncio.sleep(BATCH_WINDOW)
+        conn.enqueue(get_state_payload())
+        self.broadcast_q.put_nowait(conn)
+        return conn
+
+    def _register(self, conn: Connection):
+        """Add a client and start its writer. Broadcaster only."""
+        if conn.closed:
+            return # Disconnected before its turn in the queue
+        self.active_connections.add(conn)
+        conn.writer_task = asyncio.create_task(self._writer(conn))
+
+    def disconnect(self, conn: Connection):
+        """Remove a client and stop its writer task."""
+        conn.closed = True
+        self.active_connections.discard(conn)
+        if conn.writer_task and conn.writer_task is not asyncio.current_task():
+            conn.writer_task.cancel()
 
-    def disconnect(self, websocket: WebSocket):
-        """Remove a client."""
+    async def _writer(self, conn: Connection):
+        """Drains one client's queue so a slow client only delays itself.
+        Messages arriving within BATCH_WINDOW are sent as a single batch frame.
+        """
+        queue = conn.out_queue
         try:
-            self.active_connections.remove(websocket)
-        except ValueError:
-            pass # Client already removed
-
-    async def broadcast_json(self, data: dict):
-        """Broadcast a JSON message to all connected clients."""
-        print(f"Broadcasting: {data.get('type')}")
-        # Iterate over a copy in case the list changes during iteration
-        for connection in self.active_connections[:]:
+            while True:
+                batch = [await queue.get()]
+                await asyncio.sleep(BATCH_WINDOW)
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                for payload in self._frames(batch):
+                    await conn.websocket.send_bytes(payload)
+        except (WebSocketDisconnect, RuntimeError):
+            self.disconnect(conn)
+        except Exception as e:
+            log.error("WebSocket writer error: %s", e)
+            self.disconnect(conn)
+            # Close so the browser notices and reconnects instead of going silent
             try:
-                await connection.send_json(data)
-            except (WebSocketDisconnect, RuntimeError):
-                self.disconnect(connection)
+                await conn.websocket.close(code=1011)
+            except Exception:
+                pass # Socket already unusable
+
+    @staticmethod
+    def _frames(batch: List[bytes]):
+        """Yields the frames for a batch, in order. Runs of plain JSON are
+        spliced into one batch frame; compressed payloads go out on their own.
+        """
+        run: List[bytes] = []
+        for payload in batch:
+            if not is_compressed(payload):
+                run.append(payload)
+                continue
+            if run:
+                yield run[0] if len(run) == 1 else _splice(run)
+                run = []
+            yield payload
+        if run:
+            yield run[0] if len(run) == 1 else _splice(run)
+
+    async def close_all(self):
+        """Stop every writer task and wait for all of them to finish."""
+        tasks = [c.writer_task for c in self.active_connections if c.writer_task]
+        for conn in list(self.active_connections):
+            self.disconnect(conn)
+        # Writers handle their own errors; this only collects the cancellations
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def queue_broadcast(self, data: dict):
+        """Hand a message to the broadcaster task without blocking."""
+        try:
+            self.broadcast_q.put_nowait(data)
+        except asyncio.QueueFull:
+            log.warning("Broadcast queue full, dropping: %s", data.get("type"))
+
+    async def run_broadcaster(self):
+        """Broadcasts queued messages and registers new clients, in order.
+        Runs as a background task.
+        """
+        while True:
+            item = await self.broadcast_q.get()
+            if isinstance(item, Connection):
+                self._register(item)
+            else:
+                self.broadcast_json(item)
+
+    def broadcast_json(self, data: dict):
+        """Serialize a message once and queue it for every connected client."""
+        log.debug("Broadcasting: %s", data.get("type"))
+        payload = dump_json(data)
+        # enqueue never awaits or disconnects, so no copy is needed
+        for conn in self.active_connections:
+            conn.enqueue(payload)
 
 # NEW: Create a single, global manager
 manager = ConnectionManager()
@@ -91,159 +275,194 @@ async def mqtt_listener(client: aiomqtt.Client):
     Listens for MQTT messages. Runs as a single background task.
     Calculates lap times and broadcasts them to all clients.
     """
-    global race_data
-    print(f"Subscribing to {TOPIC_TRACK1_FINISH} and {TOPIC_TRACK2_FINISH}")
-    await client.subscribe(TOPIC_TRACK1_FINISH)
-    await client.subscribe(TOPIC_TRACK2_FINISH)
+    log.info("Subscribing to %s", TOPIC_TRACK_FILTER)
+    await client.subscribe(TOPIC_TRACK_FILTER)
+
+    # Bind globals and bound methods to locals once for the hot loop.
+    # race.tracks is never reassigned, only its TrackStates are mutated.
+    state = race
+    tracks = race.tracks
+    prefix = TOPIC_TRACK_PREFIX
+    prefix_len = len(prefix)
+    num_tracks = len(tracks)
+    now = monotonic
+    tick_of = parse_tick
+    add_lap = record_lap
+    broadcast = manager.queue_broadcast
     
     try:
         async for message in client.messages:
-            if race_data["status"] != "running":
+            if state.status != "running":
                 continue
 
-            finish_time = time.monotonic()
-            track = 0
-            
-            if message.topic.value == TOPIC_TRACK1_FINISH:
-                track = 1
-            elif message.topic.value == TOPIC_TRACK2_FINISH:
-                track = 2
+            finish_time = now()
+            topic = message.topic.value
+            if not topic.startswith(prefix):
+                continue
+            try:
+                idx = int(topic[prefix_len:]) - 1
+            except ValueError:
+                continue
+            if not 0 <= idx < num_tracks:
+                continue
+
+            track = idx + 1
+            t = tracks[idx]
+            if t.lap_start_time == 0:
+                log.debug("Ignoring message on track %d: lap not started.", track)
+                continue
+
+            # Prefer the sensor's hardware ticks, which exclude MQTT jitter.
+            # The first lap starts on our clock, so it can't use them.
+            tick = tick_of(message.payload)
+            if tick is not None and t.last_tick is not None:
+                lap_time_sec = ((tick - t.last_tick) % TICK_WRAP) / 1_000_000
+            else:
+                lap_time_sec = finish_time - t.lap_start_time
+            add_lap(t, lap_time_sec)
+            t.lap_start_time = finish_time
+            t.last_tick = tick
             
-            if track > 0:
-                if race_data["tracks"][track]["lap_start_time"] == 0:
-                    print(f"Ignoring message on track {track}: lap not started.")
-                    continue
-
-                lap_time_sec = finish_time - race_data["tracks"][track]["lap_start_time"]
-                race_data["tracks"][track]["laps"].append(lap_time_sec)
-                race_data["tracks"][track]["lap_start_time"] = finish_time
-                
-                print(f"Track {track} finished lap. Time: {lap_time_sec:.3f}s")
-                # MODIFIED: Broadcast to all clients
-                await manager.broadcast_json({
-                    "type": "lap_finish", 
-                    "track": track, 
-                    "lap_time_sec": lap_time_sec
-                })
+            log.debug("Track %d finished lap. Time: %.3fs", track, lap_time_sec)
+            # MODIFIED: Broadcast to all clients
+            broadcast({
+                "type": "lap_finish", 
+                "track": track, 
+                "lap_time_sec": lap_time_sec
+            })
                 
     except asyncio.CancelledError:
-        print("MQTT listener task stopping.")
+        log.info("MQTT listener task stopping.")
     except Exception as e:
-        print(f"MQTT listener error: {e}")
+        log.error("MQTT listener error: %s", e)
 
 # MODIFIED: race_sequence now broadcasts
 async def race_sequence(client: aiomqtt.Client):
     """
     Handles the F1 start light sequence. Broadcasts updates to all clients.
     """
-    global race_data
     try:
-        print("Starting new race sequence...")
+        log.info("Starting new race sequence...")
         
         for i in range(1, 6):
             await asyncio.sleep(1.0)
-            print(f"Light {i} ON")
+            log.debug("Light %d ON", i)
             # MODIFIED: Broadcast to all clients
-            await manager.broadcast_json({"type": "light", "light_id": i, "state": "on"})
+            manager.queue_broadcast({"type": "light", "light_id": i, "state": "on"})
             
         await asyncio.sleep(random.uniform(1.0, 4.0))
         
-        print("LIGHTS OUT!")
+        log.info("LIGHTS OUT!")
         # MODIFIED: Broadcast to all clients
-        await manager.broadcast_json({"type": "lights_out"})
+        manager.queue_broadcast({"type": "lights_out"})
         
-        start_time = time.monotonic()
-        race_data["tracks"][1]["lap_start_time"] = start_time
-        race_data["tracks"][2]["lap_start_time"] = start_time
+        start_time = monotonic()
+        for t in race.tracks:
+            t.lap_start_time = start_time
+            t.last_tick = None
         
         await client.publish(TOPIC_RACE_START, "GO")
         
         # MODIFIED: Broadcast to all clients
-        await manager.broadcast_json({"type": "start_race"})
-        print(f"Race started. Lap 1 start time: {start_time}")
+        manager.queue_broadcast({"type": "start_race"})
+        log.info("Race started. Lap 1 start time: %s", start_time)
 
     except Exception as e:
-        print(f"Error during race sequence: {e}")
+        log.error("Error during race sequence: %s", e)
         # If sequence fails, reset everyone to idle
         reset_race_state()
-        await manager.broadcast_json({"type": "reset"})
+        manager.queue_broadcast({"type": "reset"})
 
 # MODIFIED: stop_race now broadcasts
 async def stop_race():
     """
     Stops the race, calculates final stats, and broadcasts to all clients.
     """
-    global race_data
-    if race_data["status"] != "running":
+    if race.status != "running":
         return
 
-    print("Stopping race...")
-    race_data["status"] = "finished"
-    race_data["tracks"][1]["lap_start_time"] = 0.0
-    race_data["tracks"][2]["lap_start_time"] = 0.0
+    log.info("Stopping race...")
+    set_status("finished")
+    for t in race.tracks:
+        t.lap_start_time = 0.0
+        t.last_tick = None
     
-    laps_1 = race_data["tracks"][1]["laps"]
-    laps_2 = race_data["tracks"][2]["laps"]
-    fastest_1 = min(laps_1) if laps_1 else 0
-    fastest_2 = min(laps_2) if laps_2 else 0
+    laps_1 = race.tracks[0].laps
+    laps_2 = race.tracks[1].laps
+    fastest_1 = race.tracks[0].fastest
+    fastest_2 = race.tracks[1].fastest
 
     # MODIFIED: Broadcast to all clients
-    await manager.broadcast_json({
+    manager.queue_broadcast({
         "type": "race_finished",
-        "track_1_laps": laps_1,
-        "track_2_laps": laps_2,
+        "track_1_laps": laps_1.tolist(),
+        "track_2_laps": laps_2.tolist(),
         "track_1_fastest": fastest_1,
         "track_2_fastest": fastest_2
     })
-    print("Race finished. Final data sent to frontend.")
+    log.info("Race finished. Final data sent to frontend.")
 
 # MODIFIED: Replace your entire 'lifespan' function with this one
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manages application startup and shutdown events."""
-    global mqtt_client, mqtt_listener_task
-    print("Application startup...")
+    global mqtt_client, mqtt_listener_task, broadcaster_task
+    log.info("Application startup...")
+
+    # Needed even without MQTT so WebSocket commands still reach clients
+    broadcaster_task = asyncio.create_task(manager.run_broadcaster())
     
     try:
         # MODIFIED: Use 'async with' to correctly manage the connection
-        async with aiomqtt.Client(BROKER_ADDRESS) as client:
-            print(f"Connected to MQTT broker at {BROKER_ADDRESS}")
+        # Disable Nagle so back-to-back lap messages aren't held ~40ms
+        async with aiomqtt.Client(
+            BROKER_ADDRESS,
+            keepalive=MQTT_KEEPALIVE,
+            socket_options=[(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)],
+        ) as client:
+            log.info("Connected to MQTT broker at %s", BROKER_ADDRESS)
             
             # Assign the connected client to the global variable
             mqtt_client = client 
             
             # Start the *single* MQTT listener task
             mqtt_listener_task = asyncio.create_task(mqtt_listener(mqtt_client))
-            print("MQTT listener task started.")
+            log.info("MQTT listener task started.")
             
             yield  # --- Application is now running ---
             
             # --- Application is shutting down (code resumes after yield) ---
-            print("Application shutting down...")
+            log.info("Application shutting down...")
             if mqtt_listener_task:
                 mqtt_listener_task.cancel()
                 # Give it a moment to cancel
                 try:
                     await mqtt_listener_task
                 except asyncio.CancelledError:
-                    print("MQTT listener task successfully cancelled.")
+                    log.info("MQTT listener task successfully cancelled.")
             
             # The 'async with' block will automatically call disconnect here
             
     except aiomqtt.exceptions.MqttError as e:
-        print(f"FATAL: Could not connect to MQTT broker: {e}. Is it running?")
+        log.critical("Could not connect to MQTT broker: %s. Is it running?", e)
         mqtt_client = None
         yield # Allow the app to start, but in a failed state
     except Exception as e:
-        print(f"An unexpected error occurred during lifespan: {e}")
+        log.error("An unexpected error occurred during lifespan: %s", e)
         mqtt_client = None
         yield # Allow the app to start, but in a failed state
     
     finally:
         # This code runs after the 'async with' block has exited
-        print("MQTT connection closed.")
+        log.info("MQTT connection closed.")
         mqtt_client = None # Ensure global client is cleared
+        broadcaster_task.cancel()
+        try:
+            await broadcaster_task
+        except asyncio.CancelledError:
+            pass
+        await manager.close_all()
 
 # --- FastAPI App ---
 app = FastAPI(lifespan=lifespan) # MODIFIED: Add the lifespan handler
@@ -253,7 +472,7 @@ try:
     with open("index.html", "r") as f:
         html_content = f.read()
 except FileNotFoundError:
-    print("FATAL ERROR: 'index.html' not found")
+    log.critical("'index.html' not found")
     exit()
 
 @app.get("/")
@@ -265,25 +484,25 @@ async def get_root():
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """Handles new client connections and incoming commands."""
-    await manager.connect(websocket) # Connect the client and send current state
+    conn = await manager.connect(websocket) # Connect the client and send current state
     
     try:
         # Only listen for commands from this client
         async for data in websocket.iter_text():
             
             if data == "start":
-                if race_data["status"] == "running":
+                if race.status == "running":
                     continue # Ignore
                 if not mqtt_client:
-                     print("ERROR: MQTT client not ready.")
+                     log.error("MQTT client not ready.")
                      continue
                 
                 # Set global state
                 reset_race_state()
-                race_data["status"] = "running"
+                set_status("running")
                 
                 # Tell ALL clients to reset their UI
-                await manager.broadcast_json({"type": "reset"})
+                manager.queue_broadcast({"type": "reset"})
                 
                 # Start the *single* race sequence task
                 asyncio.create_task(race_sequence(mqtt_client))
@@ -295,15 +514,16 @@ async def websocket_endpoint(websocket: WebSocket):
             elif data == "reset":
                 reset_race_state()
                 # Tell ALL clients to reset
-                await manager.broadcast_json({"type": "reset"})
+                manager.queue_broadcast({"type": "reset"})
                 
     except WebSocketDisconnect:
-        print("Client disconnected.")
+        log.info("Client disconnected.")
     except Exception as e:
-        print(f"An error occurred in WebSocket handler: {e}")
+        log.error("An error occurred in WebSocket handler: %s", e)
     finally:
-        manager.disconnect(websocket)
-        print("WebSocket connection closed.")
+        manager.disconnect(conn)
+        log.info("WebSocket connection closed.")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Payloads are compressed once in dump_json, not per client
+    uvicorn.run(app, host="0.0.0.0", port=8000, ws_per_message_deflate=False)
\ No newline at end of file